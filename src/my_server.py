@@ -7,18 +7,39 @@ import http.server
 import socketserver
 import json
 import logging
+import signal
+import threading
+import contextlib
+import re
+import urllib.parse
 
 __version__ = '1.0.0'
 
 logging.basicConfig(format='%(asctime)-15s %(levelname)6s: %(message)s', stream=sys.stdout)
 log = logging.getLogger()
 
+# remember the original working directory, since that's where output files such as profiles should go
+startDir = os.getcwd()
 os.chdir(os.path.dirname(__file__))
 
 parser = argparse.ArgumentParser(description='MyServer - a trivial HTTP server used to illustrate how to test a server with PySys.')
 parser.add_argument('--port', dest='port', type=int, help='The port to listen on')
 parser.add_argument('--loglevel', dest='loglevel', help='The log level e.g. INFO/DEBUG', default='INFO')
+parser.add_argument('--logformat', '--log-format', dest='logformat', choices=['text', 'json'], default='text',
+	help='The format of log messages; json writes one JSON object per line, with an "event" field identifying '
+		'the kind of message, and additional fields such as "port" depending on the event')
 parser.add_argument('--configfile', dest='configfile', help='The JSON configuration file for this server')
+parser.add_argument('--profile', dest='profile', nargs='?', const='cprofile', choices=['cprofile', 'sampling'],
+	help='Profile the handling of each request, aggregated by request path. cprofile (the default) writes .pstats files; '
+		'sampling has lower overhead and writes a collapsed-stack (flamegraph-ready) .collapsed file')
+parser.add_argument('--tracememory', '--trace-memory', dest='tracememory', action='store_true',
+	help='Trace memory allocations using tracemalloc, to find allocation sites whose memory usage grows over time. '
+		'The growth since the baseline snapshot is available from the local /admin/memory endpoint, and is written '
+		'to .memory.json and .memory.txt files at shutdown')
+parser.add_argument('--tracememoryinterval', dest='tracememoryinterval', type=float, default=10.0,
+	help='The number of seconds between the periodic memory snapshots that are recorded when tracing memory')
+parser.add_argument('--profileoutput', dest='profileoutput', help='The path prefix for profile and memory trace output files',
+	default=os.path.join(startDir, 'my_server'))
 args = parser.parse_args()
 
 if args.configfile:
@@ -29,12 +50,286 @@ if args.configfile:
 
 log.setLevel(getattr(logging, args.loglevel.upper()))
 
+class JSONLogFormatter(logging.Formatter):
+	"""
+	Formats each log record as a single-line JSON object containing the time, level, event, message and any 
+	additional fields passed to the logger using ``extra=``.
+	"""
+	STANDARD_ATTRIBUTES = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+	def format(self, record):
+		message = {
+			'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))+'.%03d'%record.msecs,
+			'level': record.levelname,
+			'event': getattr(record, 'event', 'log'),
+			'message': record.getMessage(),
+		}
+		for k, v in record.__dict__.items():
+			if k not in self.STANDARD_ATTRIBUTES and k not in message: message[k] = v
+		if record.exc_info: message['exception'] = self.formatException(record.exc_info)
+		return json.dumps(message, default=str)
+
+if args.logformat == 'json':
+	for handler in logging.getLogger().handlers: handler.setFormatter(JSONLogFormatter())
+
+class RequestProfiler(object):
+	"""
+	Base class for profilers that aggregate their results by request path. Subclasses provide a ``profileRequest`` 
+	context manager, and a ``writeResults`` method that is called when the server is shutting down.
+	"""
+	def __init__(self, outputPrefix):
+		self.outputPrefix = outputPrefix
+
+	def getPathKey(self, requestPath):
+		return urllib.parse.urlsplit(requestPath).path or '/'
+
+class CProfileRequestProfiler(RequestProfiler):
+	"""
+	Deterministic profiler using cProfile, which writes a .pstats file for each request path plus a combined
+	one for all paths.
+	"""
+	def __init__(self, outputPrefix):
+		super(CProfileRequestProfiler, self).__init__(outputPrefix)
+		import cProfile
+		self.newProfile = cProfile.Profile
+		self.profiles = {} # key=path
+
+	@contextlib.contextmanager
+	def profileRequest(self, requestPath):
+		profile = self.profiles.get(self.getPathKey(requestPath))
+		if profile is None: profile = self.profiles[self.getPathKey(requestPath)] = self.newProfile()
+		profile.enable()
+		try:
+			yield
+		finally:
+			profile.disable()
+
+	def writeResults(self):
+		if not self.profiles: return
+		import pstats
+		combined = None
+		for path, profile in sorted(self.profiles.items()):
+			filename = '%s.profile.%s.pstats'%(self.outputPrefix, re.sub(r'[^\w.-]+', '_', path.strip('/')) or 'root')
+			profile.dump_stats(filename)
+			if combined is None: combined = pstats.Stats(profile)
+			else: combined.add(profile)
+		combined.dump_stats(self.outputPrefix+'.profile.pstats')
+		log.info('Wrote cProfile results for %d request paths to: %s.profile*.pstats', len(self.profiles), self.outputPrefix, 
+			extra={'event':'profileWritten', 'paths':len(self.profiles)})
+
+class SamplingRequestProfiler(RequestProfiler):
+	"""
+	Low-overhead statistical profiler that periodically samples the stack of the thread handling requests, and
+	writes the results in collapsed-stack format (``path;frame;frame... count``) which can be rendered as a flamegraph.
+	"""
+	def __init__(self, outputPrefix, interval=0.005):
+		super(SamplingRequestProfiler, self).__init__(outputPrefix)
+		self.interval = interval
+		self.stacks = {} # key=collapsed stack string, value=sample count
+		self.current = None # (thread id, path key) of the request being handled, if any
+		self.stopping = threading.Event()
+		self.thread = threading.Thread(target=self.__sample, name='profiler', daemon=True)
+		self.thread.start()
+
+	@contextlib.contextmanager
+	def profileRequest(self, requestPath):
+		self.current = (threading.get_ident(), self.getPathKey(requestPath))
+		try:
+			yield
+		finally:
+			self.current = None
+
+	def __sample(self):
+		while not self.stopping.wait(self.interval):
+			current = self.current
+			if current is None: continue # idle
+			frame = sys._current_frames().get(current[0])
+			stack = []
+			while frame is not None:
+				stack.append('%s:%s'%(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+				frame = frame.f_back
+			stack.append(current[1])
+			key = ';'.join(reversed(stack))
+			self.stacks[key] = self.stacks.get(key, 0)+1
+
+	def writeResults(self):
+		self.stopping.set()
+		self.thread.join()
+		with open(self.outputPrefix+'.profile.collapsed', 'w', encoding='utf-8') as f:
+			for stack, count in sorted(self.stacks.items()):
+				f.write('%s %d\n'%(stack, count))
+		log.info('Wrote %d profile samples to: %s.profile.collapsed', sum(self.stacks.values()), self.outputPrefix, 
+			extra={'event':'profileWritten', 'samples':sum(self.stacks.values())})
+
+class MemoryTracer(object):
+	"""
+	Traces memory allocations using tracemalloc, and compares snapshots against a baseline snapshot to find the 
+	allocation sites (file and line) whose memory usage is growing. A snapshot is also taken periodically so that the 
+	history of memory usage can be written at shutdown. 
+	"""
+	def __init__(self, outputPrefix, interval):
+		import tracemalloc
+		self.tracemalloc = tracemalloc
+		tracemalloc.start()
+		self.outputPrefix = outputPrefix
+		self.interval = interval
+		self.startTime = time.time()
+		self.requestCount = 0
+		self.history = [] # a dict for each periodic snapshot
+		self.lock = threading.Lock()
+		self.baseline = self.takeSnapshot()
+		self.baselineRequestCount = 0
+		self.stopping = threading.Event()
+		self.thread = threading.Thread(target=self.__snapshotPeriodically, name='memorytracer', daemon=True)
+		self.thread.start()
+
+	def takeSnapshot(self):
+		# exclude allocations by tracemalloc itself, such as the baseline snapshot
+		return self.tracemalloc.take_snapshot().filter_traces([
+			self.tracemalloc.Filter(False, self.tracemalloc.__file__),
+			self.tracemalloc.Filter(False, '<unknown>'),
+		])
+
+	def __snapshotPeriodically(self):
+		while not self.stopping.wait(self.interval):
+			tracedBytes = sum(stat.size for stat in self.takeSnapshot().statistics('filename'))
+			self.history.append({'time':round(time.time()-self.startTime, 1), 'requests':self.requestCount, 'tracedBytes':tracedBytes})
+			log.debug('Memory snapshot: %d traced bytes after %d requests', tracedBytes, self.requestCount, 
+				extra={'event':'memorySnapshot', 'requests':self.requestCount, 'tracedBytes':tracedBytes})
+
+	def getReport(self, top=10, resetBaseline=False):
+		"""
+		Take a snapshot and compare it to the baseline. 
+		
+		:param int top: The maximum number of growing allocation sites to include. 
+		:param bool resetBaseline: If True, the new snapshot becomes the baseline for future reports. 
+		:return: A dict containing the number of "requests" since the baseline, the current "tracedBytes", the 
+			"growthBytes" since the baseline, and the "topGrowth" allocation sites. 
+		"""
+		with self.lock:
+			snapshot = self.takeSnapshot()
+			growth = sorted(snapshot.compare_to(self.baseline, 'lineno'), key=lambda stat: -stat.size_diff)
+			report = {
+				'requests': self.requestCount-self.baselineRequestCount,
+				'tracedBytes': sum(stat.size for stat in growth),
+				'growthBytes': sum(stat.size_diff for stat in growth),
+				'topGrowth': [{
+						'site': '%s:%d'%(stat.traceback[0].filename, stat.traceback[0].lineno),
+						'sizeDiff': stat.size_diff, 
+						'countDiff': stat.count_diff,
+						'size': stat.size,
+					} for stat in growth[:top] if stat.size_diff > 0],
+			}
+			if resetBaseline:
+				self.baseline, self.baselineRequestCount = snapshot, self.requestCount
+			return report
+
+	def writeResults(self):
+		self.stopping.set()
+		self.thread.join()
+		report = self.getReport(top=50)
+		report['history'] = self.history
+		with open(self.outputPrefix+'.memory.json', 'w', encoding='utf-8') as f:
+			json.dump(report, f, indent='\t')
+		with open(self.outputPrefix+'.memory.txt', 'w', encoding='utf-8') as f:
+			f.write('Memory growth of %d bytes after %d requests; top growing allocation sites:\n'%(report['growthBytes'], report['requests']))
+			for site in report['topGrowth']:
+				f.write('%+10d bytes %+7d blocks  %s\n'%(site['sizeDiff'], site['countDiff'], site['site']))
+		log.info('Wrote memory trace to: %s.memory.json', self.outputPrefix, 
+			extra={'event':'memoryTraceWritten', 'growthBytes':report['growthBytes'], 'requests':report['requests']})
+
+memoryTracer = MemoryTracer(args.profileoutput, args.tracememoryinterval) if args.tracememory else None
+
+profiler = None
+if args.profile == 'cprofile':
+	profiler = CProfileRequestProfiler(args.profileoutput)
+elif args.profile == 'sampling':
+	profiler = SamplingRequestProfiler(args.profileoutput)
+
 class MyHandler(http.server.SimpleHTTPRequestHandler):
 	# TODO: add something that returns an error
-	pass
+
+	def do_GET(self):
+		if memoryTracer is not None:
+			if urllib.parse.urlsplit(self.path).path == '/admin/memory': return self.sendMemoryReport()
+			memoryTracer.requestCount += 1
+		if profiler is None: return super().do_GET()
+		with profiler.profileRequest(self.path):
+			return super().do_GET()
+
+	def do_HEAD(self):
+		if memoryTracer is not None: memoryTracer.requestCount += 1
+		if profiler is None: return super().do_HEAD()
+		with profiler.profileRequest(self.path):
+			return super().do_HEAD()
+
+	def sendMemoryReport(self):
+		"""
+		Handles the /admin/memory endpoint, which returns the memory growth since the baseline as JSON. Supports 
+		query parameters "top" (the number of allocation sites), and "reset=true" to make a new baseline. 
+		"""
+		if not self.isLocalClient(): return self.send_error(403, 'The admin endpoint is only available to local clients')
+		query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+		report = memoryTracer.getReport(top=int(query.get('top', ['10'])[0]), 
+			resetBaseline=query.get('reset', [''])[0].lower() == 'true')
+		body = json.dumps(report, indent='\t').encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def do_POST(self):
+		if urllib.parse.urlsplit(self.path).path != '/admin/shutdown':
+			return self.send_error(501, 'Unsupported method (%r)' % self.command)
+		self.shutdownServer()
+
+	def shutdownServer(self):
+		"""
+		Handles the /admin/shutdown endpoint, which stops the server cleanly (writing any profiles etc) on all 
+		platforms, unlike killing the process which on Windows gives no chance to clean up. 
+		"""
+		if not self.isLocalClient(): return self.send_error(403, 'The admin endpoint is only available to local clients')
+		log.info('Shutdown requested', extra={'event':'shutdownRequested'})
+		self.send_response(200)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+		# shutdown() blocks until serve_forever() returns, so must not be called from the thread handling this request
+		threading.Thread(target=httpd.shutdown, name='shutdown').start()
+
+	def isLocalClient(self):
+		return self.client_address[0] in ['127.0.0.1', '::1']
+
+	# In json mode, send the request log messages (which are usually written to stderr) to the logger, with fields 
+	# that can be checked by tests
+	def log_request(self, code='-', size='-'):
+		if args.logformat != 'json': return super().log_request(code, size)
+		status = int(code) if isinstance(code, int) else None # usually an http.HTTPStatus
+		log.info('%s %s %s', self.command, self.path, code if status is None else status, 
+			extra={'event':'request', 'method':self.command, 'path':self.path, 'status':status})
+
+	def log_error(self, format, *args_):
+		if args.logformat != 'json': return super().log_error(format, *args_)
+		log.warning(format, *args_, extra={'event':'requestError', 'path':getattr(self, 'path', None)})
+
+	def log_message(self, format, *args_):
+		if args.logformat != 'json': return super().log_message(format, *args_)
+		log.info(format, *args_, extra={'event':'httpMessage'})
 
 httpd = socketserver.TCPServer(("", args.port), MyHandler)
 
-log.debug('Initializing server with args: %s', sys.argv[1:])
-log.info("Started MyServer v%s on port %d", __version__, args.port)
-httpd.serve_forever()
+# Convert SIGTERM (e.g. from PySys stopping the process) into a clean shutdown so that profiles etc are written
+def onTerminate(signum, frame): sys.exit(0)
+signal.signal(signal.SIGTERM, onTerminate)
+
+log.debug('Initializing server with args: %s', sys.argv[1:], extra={'event':'initializing'})
+log.info("Started MyServer v%s on port %d", __version__, args.port, extra={'event':'started', 'version':__version__, 'port':args.port})
+try:
+	httpd.serve_forever()
+except KeyboardInterrupt:
+	pass
+finally:
+	log.info("Stopping MyServer", extra={'event':'stopping'})
+	httpd.server_close()
+	if profiler is not None: profiler.writeResults()
+	if memoryTracer is not None: memoryTracer.writeResults()
@@ -0,0 +1,36 @@
+import pstats
+import pysys
+from pysys.constants import *
+
+class PySysTest(pysys.basetest.BaseTest):
+	def execute(self):
+		# The test plugin passes the profiling options to the server, writing the profile output files next to the 
+		# server's stdout/err files
+		cprofileServer = self.myserver.startServer(name='my_server_cprofile', profile=True)
+		samplingServer = self.myserver.startServer(name='my_server_sampling', profile='sampling')
+		
+		for server in [cprofileServer, samplingServer]:
+			for i in range(3):
+				self.startPython([self.input+'/httpget.py', f'http://localhost:{server.info["port"]}/data/myfile.json'], 
+					stdouterr=self.allocateUniqueStdOutErr('httpget_myfile'))
+			self.startPython([self.input+'/httpget.py', f'http://localhost:{server.info["port"]}/'], 
+				stdouterr=self.allocateUniqueStdOutErr('httpget_root'))
+		
+			# Profiles are only written when the server shuts down; stop it cleanly so this works on Windows too
+			self.myserver.stopServer(server)
+
+	def validate(self):
+		# cProfile produces one pstats file per request path, plus a combined file
+		for f in ['my_server_cprofile.profile.pstats', 'my_server_cprofile.profile.data_myfile.json.pstats', 'my_server_cprofile.profile.root.pstats']:
+			self.assertPathExists(f)
+		
+		# check that the per-path file only includes requests for that path
+		stats = pstats.Stats(self.output+'/my_server_cprofile.profile.data_myfile.json.pstats').stats
+		self.assertThat('sendHeadCalls == expected', expected=3, 
+			sendHeadCalls=sum(s[1] for (file, line, function), s in stats.items() if function == 'send_head'))
+
+		# The sampling profiler produces a single collapsed-stack file; samples may not be captured for very quick 
+		# requests, but any that are must be rooted at the request path
+		self.assertPathExists('my_server_sampling.profile.collapsed')
+		self.assertGrep('my_server_sampling.profile.collapsed', expr=r'^(?!(/data/myfile.json|/);.+ [0-9]+$)', contains=False)
+		self.assertGrep('my_server_sampling.out', expr='Wrote [0-9]+ profile samples')
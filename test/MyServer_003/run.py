@@ -0,0 +1,24 @@
+import pysys
+from pysys.constants import *
+
+class PySysTest(pysys.basetest.BaseTest):
+	def execute(self):
+		server = self.myserver.startServer(arguments=['--loglevel', 'DEBUG'], logFormat='json')
+		self.serverPort = port = server.info['port']
+
+		# Waiting for an event only parses the log lines written since the last check, however large the log gets
+		self.myserver.waitForLogEvent(server, event='started', port=port)
+
+		self.startPython([self.input+'/httpget.py', f'http://localhost:{port}/data/myfile.json'], stdouterr='httpget_myfile')
+		self.startPython([self.input+'/httpget.py', f'http://localhost:{port}/non-existent-path'], stdouterr='httpget_nonexistent', 
+			expectedExitStatus='!= 0')
+		self.myserver.waitForLogEvent(server, event='request', path='/non-existent-path', status=404)
+
+	def validate(self):
+		self.myserver.assertLogEvent('my_server.out', event='started', port=self.serverPort, expectedCount=1)
+		self.myserver.assertLogEvent('my_server.out', event='request', method='GET', path='/data/myfile.json', status=200, expectedCount=1)
+		self.myserver.assertLogEvent('my_server.out', event='requestError', path='/non-existent-path', level='WARNING')
+
+		# Every line should be a structured record
+		self.assertThat('unstructuredLines == []', unstructuredLines=[r['message'] for r in 
+			self.myserver.getLogEvents('my_server.out') if 'event' not in r])
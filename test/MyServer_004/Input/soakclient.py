@@ -0,0 +1,13 @@
+# Simple HTTP client that sends the specified number of requests, cycling through a list of URLs
+# Usage: soakclient.py REQUESTS URL...
+
+import urllib.request, urllib.error, sys
+count, urls = int(sys.argv[1]), sys.argv[2:]
+errors = 0
+for i in range(count):
+	try:
+		with urllib.request.urlopen(urls[i % len(urls)]) as r:
+			r.read()
+	except urllib.error.HTTPError as ex:
+		errors += 1
+print('Sent %d requests (%d returned an HTTP error)'%(count, errors))
@@ -0,0 +1,61 @@
+import pysys
+from pysys.constants import *
+
+class PySysTest(pysys.basetest.BaseTest):
+	# These can be overridden on the command line for a longer soak, e.g. -XrequestsPerCycle=100000 -XsoakCycles=10
+	soakCycles = 3
+	requestsPerCycle = 2000
+	warmupRequests = 500
+	maxGrowthBytesPer10kRequests = 64*1024
+
+	def execute(self):
+		if self.soakCycles < 2:
+			self.abort(BLOCKED, 'At least 2 soak cycles are needed to measure the growth rate, but soakCycles=%d'%self.soakCycles)
+
+		server = self.myserver.startServer(traceMemory=True)
+		port = server.info['port']
+		urls = [f'http://localhost:{port}{path}' for path in ['/data/myfile.json', '/', '/non-existent-path']]
+		
+		def sendRequests(count, name):
+			self.startPython([self.input+'/soakclient.py', str(count)]+urls, stdouterr=self.allocateUniqueStdOutErr(name), 
+				timeout=max(TIMEOUTS['WaitForProcess'], count/50))
+
+		# Let caches and lazily-initialized state settle before taking the baseline
+		sendRequests(self.warmupRequests, 'soakclient_warmup')
+		self.myserver.getMemoryReport(server, resetBaseline=True)
+		
+		self.checkpoints = []
+		for cycle in range(self.soakCycles):
+			sendRequests(self.requestsPerCycle, 'soakclient')
+			report = self.myserver.getMemoryReport(server, top=20)
+			self.log.info('After soak cycle %d: %d bytes of growth after %d requests', cycle+1, report['growthBytes'], report['requests'])
+			self.checkpoints.append(report)
+
+		self.assertThat('server.running()', server=server)
+		self.myserver.stopServer(server) # stop cleanly (even on Windows) so the memory trace is written
+
+	def validate(self):
+		# Use a least-squares fit of the growth at each measured checkpoint, so that one-off allocations (which affect 
+		# the intercept but not the slope) don't count as a leak. The baseline itself isn't included, since any one-off 
+		# allocations during the first cycle would then increase the slope
+		n = len(self.checkpoints)
+		x = [c['requests'] for c in self.checkpoints]
+		y = [c['growthBytes'] for c in self.checkpoints]
+		meanX, meanY = sum(x)/n, sum(y)/n
+		slope = sum((xi-meanX)*(yi-meanY) for xi, yi in zip(x, y))/sum((xi-meanX)**2 for xi in x)
+		growthPer10kRequests = int(slope*10000)
+
+		# Write a report of the growth and the top growing allocation sites, which is collected as a test artifact
+		final = self.checkpoints[-1]
+		with open(self.output+'/soak.memory.txt', 'w', encoding='utf-8') as f:
+			f.write('Heap growth: %d bytes per 10k requests (threshold %d)\n\n'%(growthPer10kRequests, self.maxGrowthBytesPer10kRequests))
+			f.write('Requests  Growth (bytes)\n')
+			for c in self.checkpoints: f.write('%8d  %14d\n'%(c['requests'], c['growthBytes']))
+			f.write('\nTop growing allocation sites after %d requests:\n'%final['requests'])
+			for site in final['topGrowth']:
+				f.write('%+10d bytes %+7d blocks  %s\n'%(site['sizeDiff'], site['countDiff'], site['site']))
+
+		self.assertThat('growthPer10kRequests <= maxGrowthBytesPer10kRequests', growthPer10kRequests=growthPer10kRequests, 
+			maxGrowthBytesPer10kRequests=self.maxGrowthBytesPer10kRequests, 
+			topGrowingSite=final['topGrowth'][0]['site'] if final['topGrowth'] else None)
+		self.assertGrep('my_server.out', expr='Wrote memory trace to')
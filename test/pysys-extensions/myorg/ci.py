@@ -25,7 +25,7 @@ environment variables associated with their CI system are set.
 __all__ = ["GitHubActionsCIWriter"]
 
 import time, logging, sys, threading, os
-import re
+import re, io, json, shutil, tempfile, atexit, heapq
 
 from pysys.constants import *
 from pysys.writer import BaseRecordResultsWriter, BaseResultsWriter
@@ -69,6 +69,10 @@ class TestOutcomeSummaryGenerator(BaseResultsWriter):
 	If subclasses provide their own implementation of `setup` and `processResult` they must ensure this class's 
 	methods of those names are also called. Then the summary can be obtained from `logSummary` or `getSummaryText`, 
 	typically in the writer's `cleanup` method. 
+	
+	To keep memory usage bounded for very large multi-cycle runs, only the details of failures are stored (other 
+	outcomes are just counted), and once there are more than `maxFailuresInMemory` failures their details are 
+	appended to temporary files on disk instead. 
 	"""
 	
 	showOutcomeReason = True
@@ -87,21 +91,165 @@ class TestOutcomeSummaryGenerator(BaseResultsWriter):
 	"""Configures whether the summary includes a short list of the failing test ids in a form that's easy to paste onto the 
 	command line to re-run the failed tests. """
 
+	maxFailuresInMemory = 10000
+	"""Configures the number of failures whose details are held in memory; beyond this, details of all failures are 
+	written to temporary files on disk. """
+
+	showTimeBreakdown = False
+	"""Configures whether the summary includes the slowest tests, the tests with the most setup/teardown overhead, 
+	a histogram of test durations, and (for multi-threaded runs) the parallel efficiency. 
+	
+	The setup/teardown overhead of a test is the time spent before the test's ``setup`` method is called 
+	(e.g. cleaning the output directory, loading the test and setting up test plugins) plus the time spent in 
+	its ``cleanup`` method. This is only measured if this property is enabled when the writer is set up. """
+
+	timeBreakdownTopN = 10
+	"""Configures how many tests are listed in each part of the time breakdown. """
+	
+	DURATION_HISTOGRAM_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600]
+	"""The upper bound (in seconds) of each bucket in the test duration histogram, except the last which is unbounded. """
 	
 	def setup(self, cycles=0, threads=0, **kwargs):
-		self.results = {}
 		self.startTime = time.time()
 		self.duration = 0.0
-		for cycle in range(cycles):
-			self.results[cycle] = {}
-			for outcome in PRECEDENT: self.results[cycle][outcome] = []
+		self.cycles = cycles
 		self.threads = threads
 		self.outcomes = {o: 0 for o in PRECEDENT}
+		
+		# key=(cycle, outcome) value=list of (id, reason, outputdir) for each failure, in the order they were reported
+		self.failures = {}
+		self.__failuresSpillDir = None
+		self.__maxFailuresInMemory = int(self.maxFailuresInMemory)
+
+		self.showTimeBreakdown = str(self.showTimeBreakdown).lower() == 'true'
+		self.timeBreakdownTopN = int(self.timeBreakdownTopN)
+		# min-heaps of (secs, id, cycle, duration), so only the top N are ever stored
+		self.__slowestTests = []
+		self.__mostOverheadTests = []
+		self.__durationHistogram = [0]*(len(self.DURATION_HISTOGRAM_BUCKETS)+1)
+		self.__testTimings = {} # key=id(testObj) value=[time before setup, time before cleanup]
+		self.__testTimingsLock = threading.Lock()
+
+	def processTestStarting(self, testObj, cycle=-1, **kwargs):
+		if not self.showTimeBreakdown: return
+		timings = [time.time(), None]
+		with self.__testTimingsLock: self.__testTimings[id(testObj)] = timings
+		
+		# there's no writer callback when cleanup starts, so intercept the call to this test object's cleanup method
+		cleanup = testObj.cleanup
+		def timedCleanup():
+			timings[1] = time.time()
+			return cleanup()
+		testObj.cleanup = timedCleanup
 
 	def processResult(self, testObj, cycle=-1, testTime=-1, testStart=-1, **kwargs):
-		self.results[cycle][testObj.getOutcome()].append( (testObj.descriptor.id, testObj.getOutcomeReason(), testObj.output))
-		self.outcomes[testObj.getOutcome()] += 1
+		outcome = testObj.getOutcome()
+		self.outcomes[outcome] += 1
 		self.duration = self.duration + testTime
+		self.__addTestTime(testObj, cycle, testTime, testStart)
+		if outcome not in FAILS: return
+		
+		# the same id is reported for every cycle, so interning avoids storing many copies of the same string
+		failure = (sys.intern(testObj.descriptor.id), testObj.getOutcomeReason(), testObj.output)
+		if self.__failuresSpillDir is None:
+			self.failures.setdefault((cycle, outcome), []).append(failure)
+			if sum([self.outcomes[o] for o in FAILS]) > self.__maxFailuresInMemory: 
+				self.__spillFailures()
+		else:
+			self.__appendSpilledFailures((cycle, outcome), [failure])
+
+	def __spillFailuresPath(self, key):
+		return os.path.join(self.__failuresSpillDir, 'cycle%d_%s.jsonl'%(key[0], PRECEDENT.index(key[1])))
+	
+	def __appendSpilledFailures(self, key, failures):
+		self.failures[key] = None # once spilled, the details are only held on disk; the key just records that it exists
+		with io.open(self.__spillFailuresPath(key), 'a', encoding='utf-8') as f:
+			for failure in failures: f.write(json.dumps(failure)+'\n')
+
+	def __spillFailures(self):
+		self.__failuresSpillDir = tempfile.mkdtemp(prefix='pysys_failures_')
+		atexit.register(shutil.rmtree, self.__failuresSpillDir, True)
+		log.debug('%s is writing details of failures to %s since maxFailuresInMemory was exceeded', 
+			self.__class__.__name__, self.__failuresSpillDir)
+		for key in list(self.failures): 
+			self.__appendSpilledFailures(key, self.failures[key])
+	
+	def __addTestTime(self, testObj, cycle, testTime, testStart):
+		testId = sys.intern(testObj.descriptor.id)
+		def addToHeap(heap, secs):
+			item = (secs, testId, cycle, testTime)
+			if len(heap) < self.timeBreakdownTopN: heapq.heappush(heap, item)
+			elif item > heap[0]: heapq.heapreplace(heap, item)
+		addToHeap(self.__slowestTests, testTime)
+		
+		bucket = 0
+		while bucket < len(self.DURATION_HISTOGRAM_BUCKETS) and testTime >= self.DURATION_HISTOGRAM_BUCKETS[bucket]: bucket += 1
+		self.__durationHistogram[bucket] += 1
+		
+		with self.__testTimingsLock: timings = self.__testTimings.pop(id(testObj), None)
+		if timings and testStart > 0:
+			overhead = timings[0]-testStart
+			if timings[1] is not None: overhead += testStart+testTime-timings[1]
+			addToHeap(self.__mostOverheadTests, max(0.0, overhead))
+
+	def getTimeBreakdown(self):
+		"""
+		Get the time breakdown for this test run, as included in the summary if `showTimeBreakdown` is enabled. 
+		
+		:return dict: A JSON-serializable dictionary containing ``slowestTests`` and ``mostOverheadTests`` 
+			(lists of dictionaries with ``id``, ``cycle``, ``duration`` and for the latter ``overhead``, in descending 
+			order), ``durationHistogram`` (a list of dictionaries with ``minSecs``, ``maxSecs`` and ``count``), 
+			``threads``, ``absoluteDuration``, ``additiveDuration`` and ``parallelEfficiency`` (a fraction, or None if 
+			not available). 
+		"""
+		def sortedTests(heap, key):
+			return [dict([('id', id), ('cycle', cycle+1), ('duration', round(duration, 2))]+
+					([] if key == 'duration' else [(key, round(secs, 2))])) 
+				for (secs, id, cycle, duration) in sorted(heap, key=lambda item: [-item[0], item[1], item[2]])]
+		bounds = [0]+self.DURATION_HISTOGRAM_BUCKETS+[None]
+		absoluteDuration = time.time() - self.startTime
+		return {
+			'slowestTests': sortedTests(self.__slowestTests, 'duration'),
+			'mostOverheadTests': sortedTests(self.__mostOverheadTests, 'overhead'),
+			'durationHistogram': [{'minSecs': bounds[i], 'maxSecs': bounds[i+1], 'count': count} 
+				for i, count in enumerate(self.__durationHistogram)],
+			'threads': self.threads,
+			'absoluteDuration': round(absoluteDuration, 2),
+			'additiveDuration': round(self.duration, 2),
+			'parallelEfficiency': self.duration/(absoluteDuration*self.threads) if self.threads > 1 and absoluteDuration > 0 else None,
+		}
+
+	def __logTimeBreakdown(self, log):
+		breakdown = self.getTimeBreakdown()
+		cyclestr = lambda t: ' [CYCLE %d]'%t['cycle'] if self.cycles > 1 else ''
+		
+		log('Slowest tests:')
+		for t in breakdown['slowestTests']:
+			log('  %8.2f secs  %s%s', t['duration'], t['id'], cyclestr(t))
+		if breakdown['mostOverheadTests']:
+			log('Most setup/teardown overhead:')
+			for t in breakdown['mostOverheadTests']:
+				log('  %8.2f secs  %s%s (of %.2f secs)', t['overhead'], t['id'], cyclestr(t), t['duration'])
+		
+		log('Test duration histogram:')
+		maxCount = max([b['count'] for b in breakdown['durationHistogram']]+[1])
+		for b in breakdown['durationHistogram']:
+			label = ('%s-%s secs'%(b['minSecs'], b['maxSecs'])) if b['maxSecs'] else ('%s+ secs'%b['minSecs'])
+			bar = '#'*int(round(40.0*b['count']/maxCount))
+			log('  %-13s %6d%s', label, b['count'], ' '+bar if bar else '')
+		
+		if breakdown['parallelEfficiency'] is not None:
+			log('Parallel efficiency: %0.1f%% (additive %.2f secs / (absolute %.2f secs x %d threads))', 
+				100.0*breakdown['parallelEfficiency'], breakdown['additiveDuration'], breakdown['absoluteDuration'], self.threads)
+		log('')
+
+	def __iterFailures(self, key):
+		"""Returns an iterator over the (id, reason, outputdir) failures for the specified (cycle, outcome) key."""
+		if self.__failuresSpillDir is None: 
+			for failure in self.failures[key]: yield failure
+		else:
+			with io.open(self.__spillFailuresPath(key), encoding='utf-8') as f:
+				for line in f: yield json.loads(line)
 
 	def getSummaryText(self, **kwargs):
 		"""
@@ -118,7 +266,7 @@ class TestOutcomeSummaryGenerator(BaseResultsWriter):
 		self.logSummary(log=log, **kwargs)
 		return '\n'.join(result)
 
-	def logSummary(self, log, showDuration=None, showOutcomeStats=None, showOutcomeReason=None, showOutputDir=None, showTestIdList=None, **kwargs):
+	def logSummary(self, log, showDuration=None, showOutcomeStats=None, showOutcomeReason=None, showOutputDir=None, showTestIdList=None, showTimeBreakdown=None, **kwargs):
 		"""
 		Writes a textual summary using the specified log function, with colored output if enabled.
 		
@@ -133,6 +281,7 @@ class TestOutcomeSummaryGenerator(BaseResultsWriter):
 		if showOutcomeReason is None: showOutcomeReason = str(self.showOutcomeReason).lower() == 'true'
 		if showOutputDir is None: showOutputDir = str(self.showOutputDir).lower() == 'true'
 		if showTestIdList is None: showTestIdList = str(self.showTestIdList).lower() == 'true'
+		if showTimeBreakdown is None: showTimeBreakdown = self.showTimeBreakdown
 
 		if showDuration:
 			log(  "Completed test run at:  %s", time.strftime('%A %Y-%m-%d %H:%M:%S %Z', time.localtime(time.time())), extra=ColorLogFormatter.tag(LOG_DEBUG, 0))
@@ -153,20 +302,20 @@ class TestOutcomeSummaryGenerator(BaseResultsWriter):
 			if passed: log('Success outcomes: %s', passed, extra=ColorLogFormatter.tag(LOOKUP[PASSED].lower(), [0]))
 			log('')
 
+		if showTimeBreakdown:
+			self.__logTimeBreakdown(log)
+
 		log("Summary of failures: ")
-		fails = 0
-		for cycle in self.results:
-			for outcome, tests in self.results[cycle].items():
-				if outcome in FAILS : fails = fails + len(tests)
-		if fails == 0:
+		if not self.failures:
 			log("	THERE WERE NO FAILURES", extra=ColorLogFormatter.tag(LOG_PASSES))
 		else:
 			failedids = set()
-			for cycle in self.results:
+			for cycle in sorted(set(cycle for (cycle, outcome) in self.failures)):
 				cyclestr = ''
-				if len(self.results) > 1: cyclestr = '[CYCLE %d] '%(cycle+1)
+				if self.cycles > 1: cyclestr = '[CYCLE %d] '%(cycle+1)
 				for outcome in FAILS:
-					for (id, reason, outputdir) in self.results[cycle][outcome]: 
+					if (cycle, outcome) not in self.failures: continue
+					for (id, reason, outputdir) in self.__iterFailures((cycle, outcome)): 
 						failedids.add(id)
 						log("  %s%s: %s ", cyclestr, LOOKUP[outcome], id, extra=ColorLogFormatter.tag(LOOKUP[outcome].lower()))
 						if showOutputDir:
@@ -194,6 +343,9 @@ class TestOutputArchiveWriter(BaseRecordResultsWriter):
 
 	Publishes artifacts with category name "TestOutputArchive" and the directory (unless there are no archives) 
 	as "TestOutputArchiveDir" for any enabled `ArtifactPublisher` writers. 
+	
+	If the tests are being run in shards (see `myorg.sharding`), the shard id is included in the name of each archive 
+	so that archives from different shards do not clash if they are combined. 
 
 	.. versionadded:: 1.6.0
 
@@ -280,6 +432,7 @@ class TestOutputArchiveWriter(BaseRecordResultsWriter):
 
 		self.skippedTests = []
 		self.archivesCreated = 0
+		self.shardId = getattr(runner, 'shardId', '')
 		
 		self.__artifactWriters = [w for w in self.runner.writers if isinstance(w, ArtifactPublisher)]
 		def pub(path, category):
@@ -297,7 +450,7 @@ class TestOutputArchiveWriter(BaseRecordResultsWriter):
 		if self.skippedTests:
 			# if we hit a limit, at least record the names of the tests we missed
 			mkdir(self.destDir)
-			with io.open(self.destDir+os.sep+'skipped_artifacts.txt', 'w', encoding='utf-8') as f:
+			with io.open(self.destDir+os.sep+'skipped_artifacts%s.txt'%('.'+self.shardId if self.shardId else ''), 'w', encoding='utf-8') as f:
 				f.write('\n'.join(os.path.normpath(t) for t in self.skippedTests))
 		
 		(log.info if self.archivesCreated else log.debug)('%s created %d test output archive artifacts in: %s', 
@@ -322,6 +475,7 @@ class TestOutputArchiveWriter(BaseRecordResultsWriter):
 		if not self.shouldArchive(testObj): return 
 		
 		id = ('%s.cycle%03d'%(testObj.descriptor.id, testObj.testCycle)) if testObj.testCycle else testObj.descriptor.id
+		if self.shardId: id += '.'+self.shardId
 		
 		if self.archiveAtEndOfRun:
 			self.queuedInstructions.append([hash(id), id, testObj.output])
@@ -454,7 +608,9 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 	'artifact_CATEGORY' (for more details on artifact categories see `pysys.writer.ArtifactPublisher.publishArtifact`).
 		
 	Be sure to include a unique run id (e.g. outdir) for each OS/job in the name of any uploaded artifacts so that 
-	they do not overwrite each other when uploaded. 
+	they do not overwrite each other when uploaded. If the tests are being run in shards (see `myorg.sharding`), 
+	the shard id (e.g. "shard1of4") is included in the log group and summary annotation, and is set as the 
+	"shard" step output variable so it can be used in artifact names. 
 	
 	Only enabled when running under GitHub Actions (specifically, if the ``GITHUB_ACTIONS=true`` environment variable is set).
 	
@@ -480,6 +636,14 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 	annotations will be shown even if there are more warnings. 
 	"""
 	
+	timeBreakdownFile = '__pysys_time_breakdown_@OUTDIR@.json'
+	"""
+	If `showTimeBreakdown` is enabled, the time breakdown is included in the summary annotation (which is added as a 
+	notice if there are no failures), and is also written in JSON format to this file and published as an artifact 
+	with category "MyOrgTimeBreakdown". The path is absolute, or relative to the testRootDir, and ``@OUTDIR@`` is 
+	replaced by the basename of the output directory for this test run. 
+	"""
+	
 	def isEnabled(self, **kwargs):
 		return os.getenv('GITHUB_ACTIONS','')=='true'
 
@@ -494,10 +658,15 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 		self.remainingAnnotations = self.maxAnnotations-2 # one is used up for the non-zero exit status and one is used for the summary
 		if str(self.failureTestLogAnnotations).lower()!='true': self.remainingAnnotations = 0
 		self.failureTestLogAnnotations = []
+		self.additionalAnnotations = []
 
 		self.runner = runner
 		
 		self.runid = os.path.basename(testoutdir)
+		self.timeBreakdownFile = os.path.normpath(os.path.join(runner.project.root, 
+			self.timeBreakdownFile.replace('@OUTDIR@', os.path.basename(testoutdir))))
+		self.shardId = getattr(runner, 'shardId', '')
+		if self.shardId: self.runid += ' '+self.shardId
 		
 		if runner.printLogs is None:
 			# if setting was not overridden by user, default for CI is 
@@ -517,6 +686,20 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 	def publishArtifact(self, path, category, **kwargs):
 		self.artifacts.setdefault(category, []).append(path)
 
+	def addAnnotation(self, annotationType, message, params={}):
+		"""
+		Add an annotation that will be output at the end of the test run (regardless of whether any tests failed). 
+		
+		This can be used by other writers to report problems they detect, and must be called before this writer's 
+		`cleanup` method is invoked. 
+		
+		:param str annotationType: The type of annotation, e.g. "error" or "warning". 
+		:param str message: The annotation message. 
+		:param dict[str,str] params: Parameters for the annotation e.g. ``file``. By default the project file is used. 
+		"""
+		self.additionalAnnotations.append([annotationType, message, 
+			params or {u'file':self.runner.project.projectFile.replace(u'\\',u'/')}])
+
 	def cleanup(self, **kwargs):
 		super(GitHubActionsCIWriter, self).cleanup(**kwargs)
 
@@ -524,6 +707,14 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 		# a good place to close the folding detail section
 		self.outputGitHubCommand(u'endgroup')
 		
+		if self.shardId: self.outputGitHubCommand(u'set-output', self.shardId, params={u'name':u'shard'})
+
+		if self.showTimeBreakdown:
+			mkdir(os.path.dirname(self.timeBreakdownFile))
+			with io.open(self.timeBreakdownFile, 'w', encoding='utf-8') as f:
+				json.dump(self.getTimeBreakdown(), f, indent='\t')
+			self.runner.publishArtifact(self.timeBreakdownFile.replace('\\', '/'), 'MyOrgTimeBreakdown')
+
 		# artifact publishing, mostly for use with uploading
 		# currently categories with multiple artifacts can't be used directly with the artifact action, but this may change in future
 		for category, paths in self.artifacts.items():
@@ -534,7 +725,7 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 			self.outputGitHubCommand(u'group', u'(GitHub test failure annotations)')
 			
 			if str(self.failureSummaryAnnotations).lower()=='true':
-				self.outputGitHubCommand(u'error', self.getSummaryText(), 
+				self.outputGitHubCommand(u'error', (u'Test failures in %s:\n'%self.runid if self.shardId else u'')+self.getSummaryText(), 
 					# Slightly better than the default (".github") is to include the path to the project file
 					params={u'file':self.runner.project.projectFile.replace(u'\\',u'/')})
 			
@@ -545,6 +736,16 @@ class GitHubActionsCIWriter(BaseRecordResultsWriter, TestOutcomeSummaryGenerator
 					self.outputGitHubCommand(*a)
 
 			self.outputGitHubCommand(u'endgroup')
+		
+		elif self.showTimeBreakdown and str(self.failureSummaryAnnotations).lower()=='true':
+			self.outputGitHubCommand(u'notice', self.getSummaryText(), 
+				params={u'file':self.runner.project.projectFile.replace(u'\\',u'/')})
+
+		if self.additionalAnnotations:
+			self.outputGitHubCommand(u'group', u'(GitHub additional annotations)')
+			for a in self.additionalAnnotations:
+				self.outputGitHubCommand(*a)
+			self.outputGitHubCommand(u'endgroup')
 
 	def processResult(self, testObj, cycle=0, testTime=0, testStart=0, runLogOutput=u'', **kwargs):
 		super(GitHubActionsCIWriter, self).processResult(testObj, cycle=cycle, testTime=testTime, 
@@ -1,9 +1,64 @@
 import sys
 import os
 import json
+import time
 import logging
+import urllib.request
 
 import pysys
+from pysys.constants import *
+
+class JSONLogTailer(object):
+	"""
+	Incrementally reads a log file containing one JSON object per line (such as the output of MyServer with 
+	``--logformat json``), remembering the byte offset it has read up to so that each call only reads and parses the 
+	lines added since the previous call. Records are not kept after they have been returned, so the caller should 
+	keep any it needs. 
+	"""
+	def __init__(self, path, encoding='utf-8'):
+		self.path = path
+		self.encoding = encoding
+		self.offset = 0
+	
+	def readNewRecords(self):
+		"""
+		Read any complete lines added to the file since the last call. 
+		
+		:return: A list of the new records. Any lines that are not valid JSON (e.g. Python tracebacks) are included as 
+			records containing just a "message" field. 
+		"""
+		try:
+			f = open(self.path, 'rb')
+		except FileNotFoundError:
+			return []
+		with f:
+			if os.fstat(f.fileno()).st_size < self.offset: # the file has been truncated or replaced
+				self.offset = 0
+			f.seek(self.offset)
+			data = f.read()
+		
+		# leave any partially written final line until next time
+		end = data.rfind(b'\n')
+		if end < 0: return []
+		self.offset += end+1
+		
+		newRecords = []
+		for line in data[:end].decode(self.encoding, errors='replace').split('\n'):
+			line = line.strip()
+			if not line: continue
+			try:
+				record = json.loads(line)
+			except ValueError:
+				record = None
+			newRecords.append(record if isinstance(record, dict) else {'message': line})
+		return newRecords
+
+	@staticmethod
+	def matches(record, fields):
+		"""
+		Returns True if the record has all of the specified field values. 
+		"""
+		return all(k in record and record[k] == v for k, v in fields.items())
 
 class MyServerTestPlugin(object):
 	"""
@@ -19,6 +74,7 @@ class MyServerTestPlugin(object):
 	def setup(self, testObj):
 		self.owner = self.testObj = testObj
 		self.log = logging.getLogger('pysys.myorg.MyTestPlugin')
+		self.__logQueries = {}
 
 		# Do this if you need to execute something on cleanup:
 		testObj.addCleanupFunction(self.__myPluginCleanup)
@@ -37,13 +93,22 @@ class MyServerTestPlugin(object):
 		self.owner.write_text(json.dumps({'port':port}), configfile, encoding='utf-8')
 		return os.path.join(self.output, configfile)
 
-	def startServer(self, arguments=[], name="my_server", waitForServerUp=True, **kwargs):
+	def startServer(self, arguments=[], name="my_server", waitForServerUp=True, profile=False, logFormat=None, traceMemory=False, **kwargs):
 		"""
 		Start this server as a background process on a dynamically assigned free port, and wait for it to come up. 
 		
 		:param str name: A logical name for this server (in case a single test starts several of them). 
 			Used to define the default stdouterr and displayName
 		:param list[str] arguments: Arguments to pass to the server. 
+		:param bool|str profile: Set to True (or "cprofile") to profile the server's request handling using cProfile, 
+			or "sampling" to use the lower-overhead sampling profiler. The profile output files are written to the 
+			test output directory with the same prefix as the stdouterr files when the server is stopped using 
+			`stopServer`. 
+		:param str logFormat: The server log format, either "text" or "json". Use "json" to allow checking the log 
+			using `waitForLogEvent` and `getLogEvents`. 
+		:param bool traceMemory: Set to True to trace the server's memory allocations, so that `getMemoryReport` can 
+			be used, and a memory trace is written to the test output directory (with the same prefix as the 
+			stdouterr files) when the server is stopped using `stopServer`. 
 		:param kwargs: Additional keyword arguments are passed through to `pysys.basetest.BaseTest.startProcess()`. 
 		"""
 		# As this is a server, start in the background by default, but allow user to override by specifying background=False
@@ -59,6 +124,18 @@ class MyServerTestPlugin(object):
 		else:
 			serverPort = None
 		
+		if logFormat:
+			arguments = arguments+['--logformat', logFormat]
+
+		if profile:
+			arguments = arguments+['--profile', 'cprofile' if profile is True else profile]
+		if traceMemory:
+			arguments = arguments+['--tracememory']
+		if profile or traceMemory:
+			stdouterr = kwargs['stdouterr']
+			arguments = arguments+['--profileoutput', os.path.join(self.owner.output, 
+				stdouterr[0][:-len('.out')] if isinstance(stdouterr, tuple) else stdouterr)]
+		
 		# Use startPython rather than startProcess here so we can get Python code coverage
 		process = self.owner.startPython(
 			arguments=[self.owner.project.appHome+'/src/my_server.py']+arguments,
@@ -69,4 +146,129 @@ class MyServerTestPlugin(object):
 			self.owner.waitForSocket(serverPort, process=process)
 			
 		process.info = {'port': serverPort}
-		return process
\ No newline at end of file
+		return process
+
+	def stopServer(self, server, timeout=TIMEOUTS['WaitForProcessStop']):
+		"""
+		Stop the server cleanly using its admin shutdown endpoint, and wait for the process to exit. 
+		
+		Unlike `pysys.basetest.BaseTest.stopProcess()` - which on Windows terminates the process immediately - this 
+		gives the server a chance to write its profiles and memory trace on every platform. 
+		
+		:param pysys.process.Process server: The server process. 
+		:param int timeout: The number of seconds to wait for the process to exit. 
+		"""
+		with urllib.request.urlopen('http://localhost:%d/admin/shutdown'%server.info['port'], data=b'') as r:
+			r.read()
+		self.owner.waitProcess(server, timeout=timeout, checkExitStatus=True)
+
+	def getMemoryReport(self, server, top=10, resetBaseline=False):
+		"""
+		Get a report of the memory growth since the baseline from a server started with ``traceMemory=True``. 
+		
+		:param pysys.process.Process server: The server process. 
+		:param int top: The maximum number of growing allocation sites to include. 
+		:param bool resetBaseline: If True, the server uses the current memory usage as the baseline for future 
+			reports, for example after a warm-up period. 
+		:return: A dict containing the number of "requests" since the baseline, the current "tracedBytes", the 
+			"growthBytes" since the baseline, and a "topGrowth" list with the "site", "sizeDiff" and "countDiff" 
+			of each growing allocation site. 
+		"""
+		with urllib.request.urlopen('http://localhost:%d/admin/memory?top=%d&reset=%s'%(
+				server.info['port'], top, 'true' if resetBaseline else 'false')) as r:
+			return json.loads(r.read().decode('utf-8'))
+
+	def __queryLog(self, file, fields):
+		"""
+		Get the `JSONLogTailer` and list of matching records for this log file and set of field values, having 
+		added any matches from lines written since the previous query. Each query has its own tailer, so only the 
+		first query for a given set of fields reads the whole file, and only the matching records are kept. 
+		"""
+		path = os.path.join(self.owner.output, getattr(file, 'stdout', file))
+		key = (path, json.dumps(fields, sort_keys=True, default=repr))
+		query = self.__logQueries.get(key)
+		if query is None: query = self.__logQueries[key] = (JSONLogTailer(path), [])
+		tailer, matches = query
+		matches.extend(r for r in tailer.readNewRecords() if JSONLogTailer.matches(r, fields))
+		return tailer, matches
+
+	def getLogEvents(self, file, **fields):
+		"""
+		Get the records in a JSON log file that have the specified field values. 
+		
+		For example ``getLogEvents(server, event='request', status=404)``. Repeated calls with the same fields only 
+		parse the lines added since the previous call. 
+		
+		:param str|pysys.process.Process file: The log file path (absolute or relative to the test output 
+			directory), or a server process, in which case its stdout is used. 
+		:param fields: The field values that each record must have. 
+		:return: A list of matching records, each of which is a dict. 
+		"""
+		return list(self.__queryLog(file, fields)[1])
+
+	def waitForLogEvent(self, file, timeout=TIMEOUTS['WaitForSignal'], process=None, errorLevels=['ERROR', 'CRITICAL'], 
+			abortOnError=None, **fields):
+		"""
+		Wait until a JSON log file contains a record with the specified field values. 
+		
+		Unlike ``waitForGrep``, only the lines added since the last check are parsed, so the time taken does not 
+		grow with the size of the log (except for the first wait or `getLogEvents` call with a given set of fields, 
+		which must check what has already been written). 
+		
+		For example ``waitForLogEvent(server, event='started', port=server.info['port'])``. 
+		
+		:param str|pysys.process.Process file: The log file, or a server process (see `getLogEvents`), in which case 
+			the wait is aborted if the process terminates. 
+		:param int timeout: The number of seconds to wait before failing with TIMEDOUT. 
+		:param pysys.process.Process process: A process whose termination should abort the wait, if different to 
+			the ``file`` process. 
+		:param list[str] errorLevels: The wait is aborted with a failure if a record with any of these log levels is 
+			written during the wait (records written before the wait started are ignored). 
+		:param bool abortOnError: Set to False to add a failure outcome instead of aborting the test if the event 
+			is not found; defaults to the project's ``defaultAbortOnError``. 
+		:param fields: The field values that the record must have. 
+		:return: The first matching record, or None if it was not found (and abortOnError=False). 
+		"""
+		if abortOnError is None: abortOnError = self.owner.defaultAbortOnError
+		if process is None and hasattr(file, 'running'): process = file
+		description = ', '.join('%s=%r'%(k, v) for k, v in sorted(fields.items()))
+
+		startTime = time.time()
+		tailer, matches = self.__queryLog(file, fields) # the event may already have been written
+		self.log.info('Waiting for log event %s in %s', description, os.path.basename(tailer.path))
+		while not matches:
+			for r in tailer.readNewRecords():
+				if JSONLogTailer.matches(r, fields):
+					matches.append(r)
+					break
+				if r.get('level') in errorLevels:
+					self.owner.addOutcome(BLOCKED, 'Log error while waiting for event %s in %s: %s'%(
+						description, os.path.basename(tailer.path), r.get('message')), abortOnError=abortOnError)
+					return None
+			if matches: break
+			
+			if process is not None and not process.running():
+				self.owner.addOutcome(BLOCKED, '%s terminated while waiting for log event %s'%(process, description), 
+					abortOnError=abortOnError)
+				return None
+			if time.time()-startTime > timeout:
+				self.owner.addOutcome(TIMEDOUT, 'Timed out waiting for log event %s in %s after %d secs'%(
+					description, os.path.basename(tailer.path), timeout), abortOnError=abortOnError)
+				return None
+			time.sleep(0.1)
+		self.log.debug('Found log event %s after %.1fs: %s', description, time.time()-startTime, matches[0])
+		return matches[0]
+
+	def assertLogEvent(self, file, expectedCount=None, **fields):
+		"""
+		Assert that a JSON log file contains records with the specified field values. 
+		
+		:param str|pysys.process.Process file: The log file, or a server process (see `getLogEvents`). 
+		:param int expectedCount: The number of matching records expected, or None to require at least one. 
+		:param fields: The field values that the records must have. 
+		"""
+		actualCount = len(self.getLogEvents(file, **fields))
+		return self.owner.assertThat('actualCount > 0' if expectedCount is None else 'actualCount == expectedCount', 
+			actualCount=actualCount, expectedCount=expectedCount, 
+			assertMessage='Assert log event %s in %s%s'%(', '.join('%s=%r'%(k, v) for k, v in sorted(fields.items())), 
+				os.path.basename(getattr(file, 'stdout', file)), '' if expectedCount is None else ' occurs %d time(s)'%expectedCount))
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Contains a writer that compares the performance results from this test run against a baseline of results from
+previous runs, to detect performance regressions.
+
+This module can also be executed to merge the baseline files written by several test runs (for example the shards of
+a run that was split across several CI jobs, each of which started from the same baseline)::
+
+	python -m myorg.performance OUTPUT_FILE INPUT_FILE...
+
+"""
+
+__all__ = ["PerformanceRegressionWriter", "mergeBaselineFiles"]
+
+import os, io, sys, json, time, logging
+
+from pysys.constants import *
+from pysys.writer import BaseRecordResultsWriter
+from pysys.utils.perfreporter import CSVPerformanceFile
+from pysys.utils.fileutils import mkdir
+
+from myorg.ci import ArtifactPublisher, GitHubActionsCIWriter
+
+log = logging.getLogger('pysys.writer')
+
+def median(values):
+	values = sorted(values)
+	mid = len(values)//2
+	return values[mid] if len(values) % 2 else (values[mid-1]+values[mid])/2.0
+
+def mergeBaselineFiles(outputFile, inputFiles):
+	"""
+	Merge the specified baseline files into a new baseline file.
+
+	For each resultKey, the entry that was most recently updated is used, so if each input file started as a copy of
+	the same baseline and was then updated by a run that executed a different subset of the tests, the output contains
+	the new results from all of them.
+
+	:param str outputFile: The baseline file to write, which is overwritten if it already exists.
+	:param list[str] inputFiles: The baseline files to merge.
+	:return: The number of resultKeys in the merged baseline.
+	"""
+	merged = {}
+	for path in inputFiles:
+		with io.open(path, encoding='utf-8') as f:
+			for resultKey, entry in json.load(f).items():
+				if entry.get('lastUpdated', 0) >= merged.get(resultKey, {}).get('lastUpdated', 0):
+					merged[resultKey] = entry
+	mkdir(os.path.dirname(os.path.abspath(outputFile)))
+	with io.open(outputFile, 'w', encoding='utf-8') as f:
+		json.dump(merged, f, indent='\t', sort_keys=True)
+	return len(merged)
+
+class PerformanceRegressionWriter(BaseRecordResultsWriter, ArtifactPublisher):
+	"""
+	Writer that compares each performance result reported by tests in this run against the results for the same
+	resultKey in previous runs, and flags any regressions.
+
+	Results are collected from the "CSVPerformanceReport" artifacts published by the performance reporter. If a
+	resultKey is reported more than once in a run (e.g. with ``--cycle``), the mean of its values is used. Each result
+	is compared against the median of the last few values in the baseline file. To avoid flagging normal run-to-run
+	noise, a result is only considered a regression if it is worse than the median by more than ``madThreshold``
+	(scaled) median absolute deviations, and by at least ``minChangePercent``.
+
+	The comparison report is published as an artifact with category "MyOrgPerformanceComparison", and any regressions
+	are added as an annotation by the `myorg.ci.GitHubActionsCIWriter` (if enabled). For this to work, this writer must
+	be listed after `myorg.ci.TestOutputArchiveWriter` and before `myorg.ci.GitHubActionsCIWriter` in the project
+	configuration.
+
+	This writer is enabled when running with ``--record``.
+
+	The following properties can be set in the project configuration for this writer:
+	"""
+
+	baselineFile = '__pysys_performance_baselines/baseline_@PLATFORM@.json'
+	"""
+	The path of the JSON file containing the results of previous runs, as an absolute path, or relative to the
+	testRootDir. The string ``@PLATFORM@`` is replaced by the platform this test run is executing on (e.g. ``linux``)
+	so that each platform has its own baseline, and ``@OUTDIR@`` is replaced by the basename of the output directory
+	for this test run. Avoid using ``@OUTDIR@`` if the tests are split into shards with different output directories,
+	since then each shard would start from a different baseline. It does not matter if this file does not exist yet.
+	"""
+
+	reportFile = '__pysys_performance_comparison_@OUTDIR@.txt'
+	"""
+	The path of the comparison report written by this writer, as an absolute path, or relative to the testRootDir.
+	"""
+
+	baselineRuns = 10
+	"""
+	The number of previous values stored in the baseline for each resultKey.
+	"""
+
+	minBaselineRuns = 3
+	"""
+	The minimum number of previous values needed before a resultKey is checked for regressions.
+	"""
+
+	madThreshold = 3.0
+	"""
+	The number of (normal-consistent) median absolute deviations from the baseline median beyond which a
+	result is considered a regression.
+	"""
+
+	minChangePercent = 5.0
+	"""
+	The minimum change from the baseline median (as a percentage) for a result to be considered a regression,
+	regardless of how little noise there is in the baseline.
+	"""
+
+	failOnRegression = False
+	"""
+	If true, regressions cause the test run to fail (with a non-zero exit code); otherwise they are reported as warnings.
+	"""
+
+	updateBaseline = True
+	"""
+	If true, the results from this run are added to the baseline file at the end of the run.
+	"""
+
+	def setup(self, numTests=0, cycles=1, xargs=None, threads=0, testoutdir=u'', runner=None, **kwargs):
+		self.runner = runner
+		def getPath(path):
+			return os.path.normpath(os.path.join(runner.project.root, path
+				.replace('@OUTDIR@', os.path.basename(runner.outsubdir))
+				.replace('@PLATFORM@', PLATFORM)))
+		self.baselineFile = getPath(self.baselineFile)
+		self.reportFile = getPath(self.reportFile)
+
+		self.baselineRuns = int(self.baselineRuns)
+		self.minBaselineRuns = int(self.minBaselineRuns)
+		self.madThreshold = float(self.madThreshold)
+		self.minChangePercent = float(self.minChangePercent)
+		self.failOnRegression = str(self.failOnRegression).lower()=='true'
+		self.updateBaseline = str(self.updateBaseline).lower()=='true'
+
+		self.performanceFiles = []
+
+	def publishArtifact(self, path, category, **kwargs):
+		if category == 'CSVPerformanceReport': self.performanceFiles.append(path)
+
+	def loadBaseline(self):
+		"""
+		Load the baseline file.
+
+		:return: A dict where the key is the resultKey and the value is a dict containing the "unit",
+			"biggerIsBetter", (most recent last) "values" and "lastUpdated" time for that resultKey.
+		"""
+		if not os.path.exists(self.baselineFile): return {}
+		with io.open(self.baselineFile, encoding='utf-8') as f:
+			return json.load(f)
+
+	def compareResult(self, result, previous):
+		"""
+		Compare a result against the baseline values for its resultKey.
+
+		:param dict result: The result from the `pysys.utils.perfreporter.CSVPerformanceFile`.
+		:param list[float] previous: The baseline values for this resultKey.
+		:return: A dict containing the "baseline" median, the "changePercent" (positive means better), the
+			"threshold" (as an absolute value) and the "status" which is one of "REGRESSION", "IMPROVEMENT",
+			"OK" or "NEW" (if there are not yet enough baseline values).
+		"""
+		if len(previous) < self.minBaselineRuns:
+			return {'baseline':None, 'changePercent':None, 'threshold':None, 'status':'NEW'}
+
+		baseline = median(previous)
+		# 1.4826 scales the MAD to be consistent with the standard deviation for normally-distributed noise
+		mad = 1.4826*median([abs(v-baseline) for v in previous])
+		threshold = max(self.madThreshold*mad, abs(baseline)*self.minChangePercent/100.0)
+
+		improvement = (result['value']-baseline) if result['biggerIsBetter'] else (baseline-result['value'])
+		if improvement < -threshold:
+			status = 'REGRESSION'
+		elif improvement > threshold:
+			status = 'IMPROVEMENT'
+		else:
+			status = 'OK'
+		return {
+			'baseline':baseline,
+			'changePercent':100.0*improvement/abs(baseline) if baseline else 0.0,
+			'threshold':threshold,
+			'status':status,
+		}
+
+	def cleanup(self, **kwargs):
+		files = []
+		for path in self.performanceFiles:
+			with io.open(path, encoding='utf-8') as f:
+				files.append(CSVPerformanceFile(f.read()))
+		# combine the results for each resultKey (e.g. from multiple cycles) into their mean, so that each run adds
+		# just one value to the baseline
+		results = CSVPerformanceFile.aggregate(files).results if files else []
+		if not results: return
+
+		baseline = self.loadBaseline()
+		updated = time.time()
+		comparisons = []
+		for r in sorted(results, key=lambda r: r['resultKey']):
+			b = baseline.setdefault(r['resultKey'], {'values':[]})
+			comparisons.append((r, self.compareResult(r, b['values'])))
+
+			b['unit'], b['biggerIsBetter'] = r['unit'], r['biggerIsBetter']
+			b['values'] = (b['values']+[r['value']])[-self.baselineRuns:]
+			b['lastUpdated'] = updated
+
+		regressions = [(r, c) for (r, c) in comparisons if c['status'] == 'REGRESSION']
+
+		lines = []
+		for r, c in comparisons:
+			if c['status'] == 'NEW':
+				lines.append('%-11s %s (%s) = %s %s; not enough baseline values yet'%(c['status'], r['resultKey'], r['testId'],
+					r['value'], r['unit']))
+			else:
+				lines.append('%-11s %s (%s) = %s %s; %+.1f%% compared to baseline median %s (threshold %s)'%(c['status'],
+					r['resultKey'], r['testId'], r['value'], r['unit'], c['changePercent'], c['baseline'], c['threshold']))
+
+		mkdir(os.path.dirname(self.reportFile))
+		with io.open(self.reportFile, 'w', encoding='utf-8') as f:
+			f.write(u'Performance comparison against %s (positive change is better)\n\n%s\n'%(self.baselineFile, u'\n'.join(lines)))
+		self.runner.publishArtifact(self.reportFile.replace('\\', '/'), 'MyOrgPerformanceComparison')
+
+		if self.updateBaseline:
+			mkdir(os.path.dirname(self.baselineFile))
+			with io.open(self.baselineFile, 'w', encoding='utf-8') as f:
+				json.dump(baseline, f, indent='\t', sort_keys=True)
+
+		if not regressions:
+			log.info('%s found no performance regressions in %d results', self.__class__.__name__, len(comparisons))
+			return
+
+		message = '%d performance regression(s) detected:\n%s'%(len(regressions),
+			'\n'.join(line for line, (r, c) in zip(lines, comparisons) if c['status'] == 'REGRESSION'))
+		log.warning('%s', message)
+		for w in self.runner.writers:
+			if isinstance(w, GitHubActionsCIWriter):
+				w.addAnnotation(u'error' if self.failOnRegression else u'warning', message)
+		if self.failOnRegression:
+			self.runner.runnerErrors.append('%d performance regression(s) detected; see %s'%(len(regressions), self.reportFile))
+
+if __name__ == '__main__':
+	print('Merged %d resultKeys into %s'%(mergeBaselineFiles(sys.argv[1], sys.argv[2:]), sys.argv[1]))
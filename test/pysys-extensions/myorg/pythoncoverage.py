@@ -0,0 +1,267 @@
+"""
+Contains a writer that combines Python code coverage data incrementally while the tests are executing, so that
+there is little work left to do at the end of a run that produces thousands of coverage data files.
+
+This module can also be executed to combine coverage data files in a separate process (as used by the writer)::
+
+	python -m myorg.pythoncoverage OUTPUT_FILE INPUT_FILE...
+
+"""
+
+__all__ = ["ParallelPythonCoverageWriter", "combineCoverageDataFiles"]
+
+import os, io, sys, json, shutil, threading, subprocess, logging
+import concurrent.futures
+import xml.etree.ElementTree as ET
+
+from pysys.constants import *
+from pysys.writer import PythonCoverageWriter
+from pysys.utils.fileutils import mkdir, toLongPathSafe
+
+log = logging.getLogger('pysys.writer')
+
+def combineCoverageDataFiles(outputFile, inputFiles):
+	"""
+	Combine the specified coverage.py data files into a new data file.
+
+	Coverage data is a set of measured lines (or arcs) for each source file, so combining is a union and the result
+	does not depend on the order or grouping of the input files. Files that cannot be read - for example a file that
+	was truncated because the process writing it was killed, or that has branch data when the others have only
+	line data - are skipped rather than causing the whole combine to fail.
+
+	Works with both coverage.py 4.x and 5.0+. Unlike ``coverage combine``, the input files are not deleted.
+
+	:param str outputFile: The data file to write, which is overwritten if it already exists.
+	:param list[str] inputFiles: The data files to combine.
+	:return: A list of (path, message) tuples for any input files that were skipped.
+	"""
+	from coverage.data import CoverageData
+
+	if os.path.exists(outputFile): os.remove(outputFile)
+	skipped = []
+	legacy = hasattr(CoverageData, 'read_file') # coverage.py 4.x uses a JSON file rather than a SQLite database
+	combined = CoverageData() if legacy else CoverageData(basename=outputFile)
+	for path in inputFiles:
+		try:
+			if legacy:
+				data = CoverageData()
+				data.read_file(path)
+			else:
+				data = CoverageData(basename=path)
+				data.read()
+			combined.update(data)
+		except Exception as ex:
+			skipped.append((path, '%s: %s'%(type(ex).__name__, ex)))
+	if legacy:
+		combined.write_file(outputFile)
+	else:
+		combined.write()
+	return skipped
+
+class ParallelPythonCoverageWriter(PythonCoverageWriter):
+	"""
+	Writer that collects Python code coverage files and combines them using a pool of worker processes while the
+	tests are executing, then writes the coverage reports during runner cleanup. This is a drop-in replacement for
+	`pysys.writer.PythonCoverageWriter`, which combines all the files at the end of the run.
+
+	As soon as ``batchSize`` data files have been collected they are combined in a separate process, and the
+	resulting files are themselves combined once there are ``batchSize`` of them (a tree reduction), so the number
+	of files to combine at the end of the run stays small however many tests there are. Each process started by
+	``startPython`` (including any servers started by the test) writes its own uniquely named data file, and files
+	that cannot be read (e.g. from a server that was killed while writing its coverage) are reported as warnings
+	rather than failing the run.
+
+	At the end of the run the following are written to the ``destDir`` and published as artifacts for any
+	`myorg.ci.ArtifactPublisher` writers (so this writer should be listed before them in the project configuration):
+
+		- ``.coverage`` - the combined data file ("MyOrgPythonCoverageData"),
+		- ``coverage.xml`` - a Cobertura XML report ("MyOrgPythonCoverageXML"),
+		- ``htmlcov`` - an HTML report ("MyOrgPythonCoverageHTML"),
+		- ``coverage-summary.json`` - the overall coverage percentages ("MyOrgPythonCoverageSummary").
+
+	Requires PySys 1.6.0 or later. To enable this, run with ``-XpythonCoverage`` (or ``-XcodeCoverage``).
+
+	The following properties can be set in the project configuration for this writer (in addition to those
+	inherited from `pysys.writer.PythonCoverageWriter`):
+	"""
+
+	batchSize = 20
+	"""
+	The number of data files combined by each worker process. Must be at least 2.
+	"""
+
+	maxWorkers = 2
+	"""
+	The maximum number of worker processes combining data files at the same time. Since these compete with the
+	tests for CPU, it is best to keep this small.
+	"""
+
+	summaryFile = 'coverage-summary.json'
+	"""
+	The filename of the JSON file containing the overall coverage percentages, relative to the ``destDir``.
+	"""
+
+	def setup(self, **kwargs):
+		super(ParallelPythonCoverageWriter, self).setup(**kwargs)
+		self.batchSize = max(2, int(self.batchSize))
+		self.maxWorkers = max(1, int(self.maxWorkers))
+		self.summaryFile = os.path.join(self.destDir, self.summaryFile)
+
+		self.__lock = threading.Condition()
+		self.__pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix='coverage')
+		self.__pending = {} # key=tree level (0 for collected files), value=list of data files waiting to be combined
+		self.__inProgress = 0
+		self.__combineCount = 0
+		self.__skipped = []
+		self.__errors = []
+
+	def collectPath(self, testObj, path, **kwargs):
+		# unlike the superclass, files are deleted once they have been combined, so use a counter to make the
+		# names unique rather than checking what's already there
+		name, ext = os.path.splitext(os.path.basename(path))
+		with self.__lock:
+			self.collectedFileCount += 1
+			collectdest = os.path.join(self.destDir, (self.outputPattern
+				.replace('@TESTID@', str(testObj))
+				.replace('@FILENAME@', name)
+				.replace('.@FILENAME_EXT@', ext)
+				.replace('@UNIQUE@', '%d'%self.collectedFileCount)
+				))
+		mkdir(os.path.dirname(toLongPathSafe(collectdest)))
+		shutil.copyfile(toLongPathSafe(path.replace('/',os.sep)), toLongPathSafe(collectdest))
+
+		with self.__lock:
+			self.__addDataFile(collectdest, 0)
+
+	def __addDataFile(self, path, level):
+		# must be called with the lock held
+		files = self.__pending.setdefault(level, [])
+		files.append(path)
+		if len(files) >= self.batchSize:
+			del self.__pending[level]
+			self.__submitCombine(files, level+1)
+
+	def __submitCombine(self, files, level):
+		# must be called with the lock held
+		self.__combineCount += 1
+		self.__inProgress += 1
+		self.__pool.submit(self.__combine, files, os.path.join(self.destDir, '.coverage.combined.%d.%d'%(level, self.__combineCount)), level)
+
+	def __combine(self, files, outputFile, level):
+		"""
+		Combine the files in a separate process. If level is not None, the output is added to the pending files
+		for that level.
+		"""
+		try:
+			env = dict(os.environ)
+			env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]+
+				([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+			process = subprocess.run([sys.executable, '-m', 'myorg.pythoncoverage', outputFile]+files, env=env,
+				stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+			if process.returncode != 0:
+				raise Exception((process.stderr.strip() or process.stdout.strip()).split('\n')[-1])
+			skipped = [tuple(line.split('\t', 1)) for line in process.stdout.strip().split('\n') if line]
+
+			# keep unreadable files so they can be investigated, but delete the rest since they're no longer needed
+			for f in set(files)-set(path for (path, message) in skipped):
+				os.remove(f)
+		except Exception as ex:
+			log.debug('Failed to combine Python coverage data files %s: ', files, exc_info=True)
+			with self.__lock:
+				self.__errors.append('%s'%ex)
+				self.__inProgress -= 1
+				self.__lock.notify_all()
+		else:
+			with self.__lock:
+				self.__skipped.extend(skipped)
+				if level is not None: self.__addDataFile(outputFile, level)
+				self.__inProgress -= 1
+				self.__lock.notify_all()
+
+	def __runCoverage(self, args, dataFile):
+		env = dict(os.environ)
+		env['COVERAGE_FILE'] = dataFile
+		process = subprocess.run([sys.executable, '-m', 'coverage']+args, cwd=self.destDir, env=env,
+			stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+		if process.returncode != 0:
+			log.warning('Python coverage %s failed: %s', args[0], (process.stderr.strip() or process.stdout.strip()).split('\n')[-1])
+			return False
+		return True
+
+	def getCoverageSummary(self, xmlReport):
+		"""
+		Get the overall coverage percentages from a Cobertura XML report.
+
+		:return: A dict containing "linePercent", "linesCovered", "linesValid", and "branchPercent"
+			(or None if branch coverage was not measured).
+		"""
+		root = ET.parse(xmlReport).getroot()
+		linesValid = int(root.get('lines-valid', 0))
+		branchesValid = int(root.get('branches-valid', 0))
+		return {
+			'linePercent': round(100.0*float(root.get('line-rate', 0)), 2),
+			'linesCovered': int(root.get('lines-covered', 0)),
+			'linesValid': linesValid,
+			'branchPercent': round(100.0*float(root.get('branch-rate', 0)), 2) if branchesValid else None,
+		}
+
+	def cleanup(self, **kwargs):
+		try:
+			with self.__lock:
+				# wait for the tree reduction to finish, then keep reducing what's left until it fits in one batch
+				while True:
+					while self.__inProgress: self.__lock.wait()
+					remaining = [f for level in sorted(self.__pending) for f in self.__pending[level]]
+					nextLevel = max(list(self.__pending)+[0])+1
+					self.__pending = {}
+					if len(remaining) <= self.batchSize: break
+					for i in range(0, len(remaining), self.batchSize):
+						self.__submitCombine(remaining[i:i+self.batchSize], nextLevel)
+
+			if self.__errors:
+				raise Exception('Failed to combine Python code coverage data: %s'%self.__errors[0])
+			if not remaining:
+				log.info('No Python coverage files were generated.')
+				return
+
+			log.info('Preparing Python coverage report from %d data files in: %s', self.collectedFileCount, self.destDir)
+			dataFile = os.path.join(self.destDir, '.coverage')
+			self.__inProgress += 1
+			self.__combine(remaining, dataFile, None)
+			if self.__errors:
+				raise Exception('Failed to combine Python code coverage data: %s'%self.__errors[0])
+
+			for path, message in sorted(self.__skipped):
+				log.warning('Ignored unreadable Python coverage data file %s: %s', os.path.basename(path), message)
+
+			# generate the reports in parallel
+			xmlReport = os.path.join(self.destDir, 'coverage.xml')
+			htmlReport = os.path.join(self.destDir, 'htmlcov')
+			xmlDone = self.__pool.submit(self.__runCoverage, ['xml', '-o', xmlReport], dataFile)
+			htmlDone = self.__pool.submit(self.__runCoverage, ['html', '-d', htmlReport]+self.getCoverageArgsList(), dataFile)
+			xmlDone, htmlDone = xmlDone.result(), htmlDone.result()
+		finally:
+			self.__pool.shutdown()
+
+		self.runner.publishArtifact(dataFile.replace('\\','/'), 'MyOrgPythonCoverageData')
+		if xmlDone:
+			summary = self.getCoverageSummary(xmlReport)
+			summary['dataFiles'] = self.collectedFileCount
+			summary['unreadableDataFiles'] = sorted(os.path.basename(path) for path, message in self.__skipped)
+			with io.open(self.summaryFile, 'w', encoding='utf-8') as f:
+				json.dump(summary, f, indent='\t')
+
+			log.info('Python code coverage: %.1f%% of %d lines%s', summary['linePercent'], summary['linesValid'],
+				'' if summary['branchPercent'] is None else ' (%.1f%% of branches)'%summary['branchPercent'])
+
+			self.runner.publishArtifact(xmlReport.replace('\\','/'), 'MyOrgPythonCoverageXML')
+			self.runner.publishArtifact(self.summaryFile.replace('\\','/'), 'MyOrgPythonCoverageSummary')
+		if htmlDone:
+			self.runner.publishArtifact(htmlReport.replace('\\','/'), 'MyOrgPythonCoverageHTML')
+
+		self.archiveAndPublish()
+
+if __name__ == '__main__':
+	# print any skipped files to stdout so the caller can report them
+	for path, message in combineCoverageDataFiles(sys.argv[1], sys.argv[2:]):
+		print('%s\t%s'%(path, message.replace('\n', ' ').replace('\t', ' ')))
@@ -0,0 +1,31 @@
+import logging
+
+from pysys.baserunner import BaseRunner
+
+from myorg.testdurations import TestDurationHistory, TestDurationHistoryWriter, sortDescriptorsByDuration
+from myorg.sharding import selectShard
+
+class MyRunner(BaseRunner):
+	"""
+	A runner that customizes which tests are executed, and in what order.
+
+	If the `myorg.testdurations.TestDurationHistoryWriter` is configured, the recorded duration history is used to
+	execute the longest tests first, so that multi-threaded runs are not left waiting for one long test at the end.
+
+	If ``-Xshard=INDEX/COUNT`` is specified, only the tests in that shard are executed (see `myorg.sharding`).
+	"""
+
+	def setup(self):
+		super(MyRunner, self).setup()
+		self.log = logging.getLogger('pysys.myorg.MyRunner')
+
+		historyWriters = [w for w in self.writers if isinstance(w, TestDurationHistoryWriter)]
+		if historyWriters:
+			self.testDurationHistory = historyWriters[0].getHistory()
+		else:
+			self.testDurationHistory = None
+
+		# shard first, so that the split doesn't depend on the execution order
+		selectShard(self, self.testDurationHistory or TestDurationHistory(None))
+		if self.testDurationHistory is not None:
+			sortDescriptorsByDuration(self.descriptors, self.testDurationHistory)
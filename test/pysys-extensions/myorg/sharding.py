@@ -0,0 +1,223 @@
+"""
+Contains support for splitting the tests into shards that can be executed in parallel by separate CI jobs, and for
+merging the per-shard results into a single report afterwards.
+
+To run one shard of the tests, pass ``-Xshard=INDEX/COUNT`` to ``pysys run`` (e.g. ``-Xshard=2/4``), using a runner
+that calls `selectShard` such as `myorg.runner.MyRunner`. Tests are assigned to shards so that each shard has a similar
+total expected duration, based on the history recorded by `myorg.testdurations.TestDurationHistoryWriter` (or the
+size of the test, for tests with no history). To ensure
+every job computes the same split, all jobs must use the same history file (e.g. one committed to version control, or
+shared with the jobs by an earlier CI job). Since durations differ between platforms, keep a separate history for each.
+Shards do not update the history file themselves (otherwise running the shards one after another in the same
+directory would give each a different split); instead pass ``--history`` when merging the summaries.
+
+To merge the summary files from each shard (see `ShardSummaryWriter`), run::
+
+	python -m myorg.sharding --history __pysys_test_durations.json shard1.json shard2.json ...
+
+"""
+
+__all__ = ["parseShard", "assignShards", "selectShard", "ShardSummaryWriter", "mergeShardSummaries"]
+
+import os, io, sys, json, time, logging
+
+from pysys.constants import *
+from pysys.writer import BaseRecordResultsWriter
+from pysys.exceptions import UserError
+from pysys.utils.fileutils import mkdir
+
+from myorg.testdurations import TestDurationHistory, getDurationKey, estimateDurations
+from myorg.ci import TestOutcomeSummaryGenerator
+
+log = logging.getLogger('pysys.writer')
+
+def parseShard(value):
+	"""
+	Parse a shard specifier.
+
+	:param str value: A string of the form ``INDEX/COUNT`` where INDEX starts from 1, e.g. ``1/4``.
+	:return: A tuple (index, count) where index starts from 1.
+	"""
+	try:
+		index, count = [int(x) for x in str(value).split('/')]
+	except ValueError:
+		raise UserError('Invalid shard "%s"; expected a value of the form INDEX/COUNT e.g. 1/4'%value)
+	if count < 1 or not 1 <= index <= count:
+		raise UserError('Invalid shard "%s"; the index must be between 1 and the number of shards'%value)
+	return index, count
+
+def assignShards(descriptors, history, count):
+	"""
+	Split the specified descriptors into groups with a similar total expected duration.
+
+	The assignment is deterministic for a given set of descriptors and history: tests are considered in order of
+	decreasing expected duration (then id) and each is added to the shard with the smallest total so far.
+	The duration of tests with no history is estimated from their size (see
+	`myorg.testdurations.estimateDurations`).
+
+	:param list[pysys.xml.descriptor.TestDescriptor] descriptors: The descriptors to be split.
+	:param myorg.testdurations.TestDurationHistory history: The duration history.
+	:param int count: The number of shards.
+	:return: A list of ``count`` lists, each containing the descriptors for one shard, in their original order.
+	"""
+	expected = estimateDurations(descriptors, history)
+
+	totals = [0.0]*count
+	shardForTest = {}
+	for d in sorted(descriptors, key=lambda d: [-expected[d.id], d.id]):
+		shard = min(range(count), key=lambda i: [totals[i], i])
+		totals[shard] += expected[d.id]
+		shardForTest[d.id] = shard
+
+	shards = [[] for i in range(count)]
+	for d in descriptors: shards[shardForTest[d.id]].append(d)
+	return shards
+
+def selectShard(runner, history):
+	"""
+	If the ``-Xshard=INDEX/COUNT`` option was specified, reduce the runner's descriptors to just those in the
+	specified shard. Must be called from the runner's `pysys.baserunner.BaseRunner.setup` method.
+
+	Sets ``runner.shard`` to the (index, count) tuple, or None if not sharding, and ``runner.shardId`` to a string
+	such as ``shard1of4`` (or an empty string) which writers can use to tag their artifacts.
+
+	:param pysys.baserunner.BaseRunner runner: The runner.
+	:param myorg.testdurations.TestDurationHistory history: The duration history.
+	"""
+	value = runner.xargs.get('shard', '') # not getXArg(), which requires PySys 1.6
+	if not value:
+		runner.shard, runner.shardId = None, ''
+		return
+	runner.shard = index, count = parseShard(value)
+	runner.shardId = 'shard%dof%d'%(index, count)
+
+	total = len(runner.descriptors)
+	runner.descriptors[:] = assignShards(runner.descriptors, history, count)[index-1]
+	log.info('Running shard %d/%d containing %d of %d tests', index, count, len(runner.descriptors), total)
+
+class ShardSummaryWriter(BaseRecordResultsWriter):
+	"""
+	Writer that records the outcome and duration of each test in a JSON file, so that the results of several
+	shards can be merged into a single report using `mergeShardSummaries`.
+
+	Publishes the summary file as an artifact with category "MyOrgShardSummary". This writer is enabled when running
+	with ``--record``.
+
+	The following properties can be set in the project configuration for this writer:
+	"""
+
+	summaryFile = '__pysys_shard_summary_@OUTDIR@.json'
+	"""
+	The path of the summary file, as an absolute path, or relative to the testRootDir.
+
+	The string ``@OUTDIR@`` is replaced by the basename of the output directory for this test run, and ``@SHARD@``
+	is replaced by the shard id (e.g. ``shard1of4``), or an empty string if not sharding.
+	"""
+
+	def setup(self, numTests=0, cycles=1, xargs=None, threads=0, testoutdir=u'', runner=None, **kwargs):
+		self.runner = runner
+		self.summaryFile = os.path.normpath(os.path.join(runner.project.root, self.summaryFile
+			.replace('@OUTDIR@', os.path.basename(runner.outsubdir))
+			.replace('@SHARD@', getattr(runner, 'shardId', ''))
+			))
+		self.startTime = time.time()
+		self.threads = threads
+		self.results = []
+
+	def processResult(self, testObj, cycle=0, testTime=0, testStart=0, **kwargs):
+		testId, mode = getDurationKey(testObj.descriptor)
+		self.results.append({
+			'id': testObj.descriptor.id,
+			'durationKey': [testId, mode],
+			'cycle': cycle,
+			'outcome': LOOKUP[testObj.getOutcome()],
+			'reason': testObj.getOutcomeReason(),
+			'outputDir': os.path.relpath(testObj.output, self.runner.project.root).replace('\\', '/'),
+			'duration': round(testTime, 2),
+		})
+
+	def cleanup(self, **kwargs):
+		mkdir(os.path.dirname(self.summaryFile))
+		with io.open(self.summaryFile, 'w', encoding='utf-8') as f:
+			json.dump({
+				'shard': '%d/%d'%self.runner.shard if getattr(self.runner, 'shard', None) else '',
+				'outDirName': os.path.basename(self.runner.outsubdir),
+				'threads': self.threads,
+				'duration': round(time.time()-self.startTime, 2),
+				'results': self.results,
+			}, f, indent='\t')
+		self.runner.publishArtifact(self.summaryFile.replace('\\', '/'), 'MyOrgShardSummary')
+
+class _MergedTestResult(object):
+	"""Provides just enough of the `pysys.basetest.BaseTest` API to pass a shard result to a results writer."""
+	class _Descriptor(object): pass
+
+	def __init__(self, result, testRootDir):
+		self.descriptor = self._Descriptor()
+		self.descriptor.id = result['id']
+		self.output = os.path.join(testRootDir, result['outputDir'])
+		self.__outcome = {LOOKUP[o]: o for o in PRECEDENT}[result['outcome']]
+		self.__reason = result['reason']
+
+	def getOutcome(self): return self.__outcome
+	def getOutcomeReason(self): return self.__reason
+
+def mergeShardSummaries(summaryFiles, log, testRootDir='.', history=None):
+	"""
+	Merge the summary files written by `ShardSummaryWriter` for each shard, and log a combined summary.
+
+	:param list[str] summaryFiles: The paths of the summary files.
+	:param Callable[format,args,kwargs=] log: The function to call for each line of the summary (e.g. print-like).
+	:param str testRootDir: The directory that the output directories in the summary files are relative to.
+	:param myorg.testdurations.TestDurationHistory history: If specified, the durations from all shards are added
+		to this history (but it is not saved).
+	:return: The number of failures.
+	"""
+	summaries = []
+	for path in summaryFiles:
+		with io.open(path, encoding='utf-8') as f:
+			summaries.append(json.load(f))
+	summaries.sort(key=lambda s: [s['shard'], s['outDirName']])
+
+	cycles = max([r['cycle'] for s in summaries for r in s['results']]+[0])+1
+	summary = TestOutcomeSummaryGenerator()
+	summary.setup(cycles=cycles, threads=max([s['threads'] for s in summaries]+[0]))
+	summary.showDuration = True
+	summary.showTestIdList = True
+
+	shardsForResult = {}
+	for s in summaries:
+		log('Shard %s (%s): %d tests in %.2f secs', s['shard'] or '-', s['outDirName'], len(s['results']), s['duration'])
+		for r in s['results']:
+			shardsForResult.setdefault((r['id'], r['cycle']), []).append(s['shard'] or s['outDirName'])
+			summary.processResult(_MergedTestResult(r, testRootDir), cycle=r['cycle'], testTime=r['duration'])
+			if history is not None and r['outcome'] != LOOKUP[SKIPPED]:
+				history.addDuration(r['durationKey'][0], r['durationKey'][1], r['duration'])
+	log('')
+
+	# if the shards computed different splits (e.g. from different histories), some tests ran twice and others not at all
+	duplicates = sorted(key for key, shards in shardsForResult.items() if len(shards) > 1)
+	for testId, cycle in duplicates:
+		log('WARNING: %s (cycle %d) was executed by more than one shard: %s', testId, cycle+1, ', '.join(shardsForResult[(testId, cycle)]))
+	if duplicates:
+		log('WARNING: %d test(s) executed by more than one shard; check that all shards used the same test duration history, '
+			'as some tests may not have been executed at all', len(duplicates))
+		log('')
+
+	# the absolute duration of a sharded run is the duration of the slowest shard
+	summary.startTime = time.time()-max([s['duration'] for s in summaries]+[0])
+	summary.logSummary(log=log)
+	return sum([summary.outcomes[o] for o in FAILS])
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Merge the summary files from several PySys test shards into a single report.')
+	parser.add_argument('--history', dest='history', help='A test duration history file to be updated with the durations from all shards')
+	parser.add_argument('--testRootDir', dest='testRootDir', default='.', help='The directory the shard output directories are relative to')
+	parser.add_argument('summaryFiles', nargs='+', help='The summary files written by ShardSummaryWriter for each shard')
+	args = parser.parse_args()
+
+	history = TestDurationHistory(args.history).load() if args.history else None
+	failures = mergeShardSummaries(args.summaryFiles, log=lambda fmt, *a, **kw: print(fmt%a), testRootDir=args.testRootDir, history=history)
+	if history is not None: history.save()
+	sys.exit(1 if failures else 0)
@@ -0,0 +1,221 @@
+"""
+Contains a writer that records how long each test takes, and helpers for using the recorded history to decide
+the order in which tests are executed.
+"""
+
+__all__ = ["TestDurationHistory", "TestDurationHistoryWriter", "getTestSize", "estimateDurations", "sortDescriptorsByDuration"]
+
+import os, io, json, logging
+
+from pysys.constants import *
+from pysys.writer import BaseResultsWriter
+from pysys.utils.fileutils import mkdir
+
+log = logging.getLogger('pysys.writer')
+
+def getDurationKey(descriptor):
+	"""
+	Get the (testId, mode) key used to identify the specified test descriptor in the duration history.
+
+	The mode is an empty string for tests that have no modes.
+	"""
+	return getattr(descriptor, 'idWithoutMode', descriptor.id), getattr(descriptor, 'mode', None) or ''
+
+class TestDurationHistory(object):
+	"""
+	A history of the duration of each test (and mode), stored as a compact JSON file with one line per test.
+
+	For each test and mode the most recent ``historySize`` durations are stored, and the expected duration is
+	the average of those.
+
+	:param str path: The path of the history file. It does not matter if this file does not exist yet.
+	:param int historySize: The number of recent durations to keep for each test and mode.
+	"""
+
+	def __init__(self, path, historySize=5):
+		self.path = path
+		self.historySize = int(historySize)
+		self.durations = {} # testId: {mode: [secs, ...]}
+
+	def load(self):
+		"""
+		Load the durations from the history file, replacing any that are currently in memory.
+
+		An empty history is used if the file does not exist or cannot be parsed.
+
+		:return: This instance, to allow chaining.
+		"""
+		self.durations = {}
+		if not os.path.exists(self.path): return self
+		try:
+			with io.open(self.path, encoding='utf-8') as f:
+				self.durations = json.load(f)['durations']
+		except Exception as ex:
+			log.warning('Ignoring invalid test duration history file %s: %s', self.path, ex)
+		return self
+
+	def save(self):
+		"""
+		Atomically write the history file.
+
+		Tests are written in sorted order, one per line, so that the file is deterministic and produces small diffs
+		if it is stored in version control.
+		"""
+		mkdir(os.path.dirname(self.path) or '.')
+		lines = [u'\t%s: %s'%(json.dumps(testId), json.dumps(self.durations[testId], sort_keys=True, separators=(',', ':')))
+			for testId in sorted(self.durations)]
+		tmp = self.path+'.tmp%d'%os.getpid()
+		with io.open(tmp, 'w', encoding='utf-8') as f:
+			f.write(u'{"version":1, "durations":{\n%s\n}}\n'%u',\n'.join(lines))
+		os.replace(tmp, self.path)
+
+	def addDuration(self, testId, mode, duration):
+		"""
+		Record a new duration sample, discarding the oldest if there are more than ``historySize``.
+
+		:param str testId: The test id (without any mode suffix).
+		:param str mode: The mode, or an empty string if the test has no modes.
+		:param float duration: The test duration in seconds.
+		"""
+		samples = self.durations.setdefault(testId, {}).setdefault(mode or '', [])
+		samples.append(round(duration, 2))
+		del samples[:-self.historySize]
+
+	def merge(self, other):
+		"""
+		Add the samples from another history into this one.
+
+		:param TestDurationHistory other: The history whose samples should be added.
+		"""
+		for testId, modes in other.durations.items():
+			for mode, samples in modes.items():
+				for duration in samples:
+					self.addDuration(testId, mode, duration)
+
+	def getExpectedDuration(self, testId, mode, default=None):
+		"""
+		Get the expected duration of the specified test and mode, which is the rolling average of the recorded
+		durations.
+
+		:return float: The expected duration in seconds, or ``default`` if there is no history for this test.
+		"""
+		samples = self.durations.get(testId, {}).get(mode or '')
+		if not samples: return default
+		return sum(samples)/len(samples)
+
+	def getDescriptorDuration(self, descriptor, default=None):
+		"""
+		Get the expected duration of the test identified by the specified descriptor.
+
+		:param pysys.xml.descriptor.TestDescriptor descriptor: The test descriptor.
+		:return float: The expected duration in seconds, or ``default`` if there is no history for this test.
+		"""
+		testId, mode = getDurationKey(descriptor)
+		return self.getExpectedDuration(testId, mode, default=default)
+
+def getTestSize(descriptor):
+	"""
+	Get the size in bytes of the test's descriptor and Python module, which is used as a rough indication of how
+	long a test with no duration history is likely to take.
+
+	:param pysys.xml.descriptor.TestDescriptor descriptor: The test descriptor.
+	:return int: The size in bytes, or 0 if the files cannot be found.
+	"""
+	module = os.path.join(descriptor.testDir, descriptor.module) # join ignores testDir if module is absolute
+	paths = {descriptor.file, module if module.endswith('.py') else module+'.py'}
+	return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+def estimateDurations(descriptors, history, defaultSecsPerKB=1.0):
+	"""
+	Get the expected duration of each of the specified tests.
+
+	Tests that have history use the rolling average of their recorded durations. For tests with no history the
+	duration is estimated from the size of the test (see `getTestSize`), scaled by the median seconds per byte of the
+	tests that do have history, or by ``defaultSecsPerKB`` if none do. This keeps the split between tests with
+	and without history sensible, and means larger tests are still run first when there is no history at all.
+
+	:param list[pysys.xml.descriptor.TestDescriptor] descriptors: The descriptors.
+	:param TestDurationHistory history: The duration history.
+	:param float defaultSecsPerKB: The scale used when no tests have history.
+	:return dict[str,float]: The expected duration in seconds, keyed by descriptor id.
+	"""
+	expected = {d.id: history.getDescriptorDuration(d) for d in descriptors}
+	sizes = {d.id: getTestSize(d) for d in descriptors}
+
+	rates = sorted(expected[d.id]/sizes[d.id] for d in descriptors if expected[d.id] is not None and sizes[d.id])
+	secsPerByte = rates[len(rates)//2] if rates else defaultSecsPerKB/1024.0
+	for d in descriptors:
+		if expected[d.id] is None: expected[d.id] = sizes[d.id]*secsPerByte
+	return expected
+
+def sortDescriptorsByDuration(descriptors, history):
+	"""
+	Sort the specified list of descriptors in-place so that the longest tests are executed first,
+	which minimizes the overall duration of multi-threaded test runs (Longest Processing Time first scheduling).
+
+	The order implied by any executionOrderHints is preserved, so this only changes the order of tests that have the
+	same hint. The duration of tests with no history is estimated from their size (see `estimateDurations`).
+
+	:param list[pysys.xml.descriptor.TestDescriptor] descriptors: The descriptors to be sorted.
+	:param TestDurationHistory history: The duration history.
+	"""
+	expected = estimateDurations(descriptors, history)
+	# Python's sort is stable, so ties are left in their existing (deterministic) order
+	descriptors.sort(key=lambda d: [d.executionOrderHint, -expected[d.id]])
+
+class TestDurationHistoryWriter(BaseResultsWriter):
+	"""
+	Writer that records the duration of each test (and mode) in a history file, so that future test runs can
+	execute the longest tests first (see `myorg.runner.MyRunner`).
+
+	This writer is always enabled (regardless of ``--record``) since the history is useful for local test runs too.
+	Skipped tests are not recorded. The history file is updated at the end of the run, merging with any changes
+	made to the file by other test runs in the meantime - except when running a shard (see `myorg.sharding`), since
+	all shards must compute their split from the same history; instead the durations from all shards are added to
+	the history when their summaries are merged.
+
+	The following properties can be set in the project configuration for this writer:
+	"""
+
+	historyFile = '__pysys_test_durations.json'
+	"""
+	The path of the history file, as an absolute path, or relative to the testRootDir.
+	"""
+
+	historySize = 5
+	"""
+	The number of recent durations kept for each test and mode, from which the rolling average is calculated.
+	"""
+
+	def isEnabled(self, **kwargs):
+		return True
+
+	def getHistory(self):
+		"""
+		Create a `TestDurationHistory` for this writer's configured history file, and load the file.
+
+		:return TestDurationHistory: The history.
+		"""
+		return TestDurationHistory(os.path.normpath(os.path.join(self.runner.project.root, self.historyFile)),
+			historySize=self.historySize).load()
+
+	def setup(self, numTests=0, cycles=1, xargs=None, threads=0, testoutdir=u'', runner=None, **kwargs):
+		self.runner = runner
+		self.newDurations = TestDurationHistory(None, historySize=self.historySize)
+
+	def processResult(self, testObj, cycle=0, testTime=0, testStart=0, **kwargs):
+		if testObj.getOutcome() == SKIPPED: return
+		testId, mode = getDurationKey(testObj.descriptor)
+		self.newDurations.addDuration(testId, mode, testTime)
+
+	def cleanup(self, **kwargs):
+		if not self.newDurations.durations: return
+		if getattr(self.runner, 'shard', None):
+			log.debug('%s not updating test duration history since this is a shard', self.__class__.__name__)
+			return
+
+		# reload just before writing to minimize the chance of losing updates from concurrent test runs
+		history = self.getHistory()
+		history.merge(self.newDurations)
+		history.save()
+		log.debug('%s updated test duration history: %s', self.__class__.__name__, history.path)